@@ -1,101 +1,192 @@
 from flask import Flask, request, jsonify
 import pandas as pd
+import pyarrow.parquet as pq
 import numpy as np
-from sklearn.neighbors import NearestNeighbors  # <--- Added import
-from sklearn.cluster import KMeans
-from sklearn.metrics.pairwise import cosine_similarity
 from flask_cors import CORS
+from numba import njit, types # JIT for the dedup priority walk
+from numba.typed import Dict
+import faiss # HNSW approximate nearest-neighbour index
+import os
+import tempfile
 import re # For cleaning track names
-from thefuzz import fuzz # For string similarity
+from rapidfuzz import fuzz, process # C++ string similarity (unrounded float scores, unlike thefuzz)
 
 app = Flask(__name__)
 CORS(app)
 
+TRACKS_PATH = "tracks_with_embeddings.parquet"
+# The cached index lives next to the parquet it was built from
+HNSW_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(TRACKS_PATH)), "tracks_hnsw.index")
+
 # Load data and ensure no NaN values
-preprocessed_tracks = pd.read_parquet("tracks_with_embeddings.parquet")
-embedding_cols = [col for col in preprocessed_tracks.columns if col.startswith('emb_')]
-preprocessed_tracks = preprocessed_tracks.dropna(subset=embedding_cols)
+# The embeddings are read straight from the parquet with pyarrow as float32, so
+# they are never up-cast to float64 or held inside a pandas frame; only the track
+# metadata columns go through pandas.
+_tracks_schema = pq.read_schema(TRACKS_PATH)
+embedding_cols = [col for col in _tracks_schema.names if col.startswith('emb_')]
+metadata_cols = [col for col in _tracks_schema.names if col not in embedding_cols]
+
+_emb_table = pq.read_table(TRACKS_PATH, columns=embedding_cols)
+_ALL_EMB = np.ascontiguousarray(np.column_stack([
+    column.to_numpy().astype(np.float32, copy=False)  # Nulls come back as NaN
+    for column in _emb_table.columns
+]))
+del _emb_table
+
+# --- Precomputed embedding matrix ---
+# preprocessed_tracks never changes while the service is running, so the
+# embeddings are kept as one contiguous float32 (N, d) matrix, sliced with row
+# indices, and preprocessed_tracks only keeps track metadata.
+_valid_rows = ~np.isnan(_ALL_EMB).any(axis=1)
+_ALL_EMB = _ALL_EMB[_valid_rows]
+# Reset the index so each row label is also its row number in _ALL_EMB
+preprocessed_tracks = pd.read_parquet(TRACKS_PATH, columns=metadata_cols)[_valid_rows].reset_index(drop=True)
+
+
+def _normalize_rows(matrix):
+    """Scale each row to unit L2 length as contiguous float32 (all-zero rows stay zero)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True).clip(1e-12)
+    return np.ascontiguousarray(matrix / norms)
+
+# Unit-length rows, normalised once here so requests only normalise their few
+# centroids; the dot product with a unit centroid is then the cosine similarity
+_ALL_EMB_NORM = _normalize_rows(_ALL_EMB)
+
+
+# --- HNSW index over the unit embeddings ---
+# Inner product on unit vectors is cosine similarity. Building the graph takes a
+# while, so it is saved next to the parquet and reloaded on restart unless the
+# parquet is newer or the row count no longer matches.
+def _load_or_build_hnsw_index():
+    if (os.path.exists(HNSW_INDEX_PATH)
+            and os.path.getmtime(HNSW_INDEX_PATH) >= os.path.getmtime(TRACKS_PATH)):
+        index = faiss.read_index(HNSW_INDEX_PATH)
+        if index.ntotal == len(_ALL_EMB_NORM) and index.d == _ALL_EMB_NORM.shape[1]:
+            print(f"Loaded HNSW index from {HNSW_INDEX_PATH}.")
+            return index
+
+    print("Building HNSW index...")
+    index = faiss.IndexHNSWFlat(_ALL_EMB_NORM.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+    # Build single-threaded. Under gunicorn's preload_app this runs in the master,
+    # which then forks the workers; libgomp is not fork-safe, so if the master has
+    # started an OpenMP thread pool the workers' first faiss search deadlocks.
+    omp_threads = faiss.omp_get_max_threads()
+    faiss.omp_set_num_threads(1)
+    try:
+        index.add(_ALL_EMB_NORM)
+    finally:
+        faiss.omp_set_num_threads(omp_threads)
+    print("HNSW index built.")
+    _save_hnsw_index(index)
+    return index
+
+
+def _save_hnsw_index(index):
+    """Cache the index on disk; failing to do so only costs a rebuild on the next start"""
+    # Write to a temp file in the same directory and atomically rename it into
+    # place, so a concurrent reader never sees a half-written index
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(HNSW_INDEX_PATH), prefix=".tracks_hnsw.", suffix=".tmp"
+        )
+        os.close(fd)
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, HNSW_INDEX_PATH)
+        print(f"HNSW index saved to {HNSW_INDEX_PATH}.")
+    except (OSError, RuntimeError) as e:  # faiss reports I/O failures as RuntimeError
+        print(f"Warning: Could not save HNSW index to {HNSW_INDEX_PATH}: {type(e).__name__} - {e}")
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+_INDEX = _load_or_build_hnsw_index()
+
+
+# --- get_user_embeddings function ---
+def _lloyd_kmeans(points, n_clusters, n_iter=5, seed=42):
+    """Small fixed-iteration Lloyd's k-means (single init) for a handful of user tracks"""
+    rng = np.random.default_rng(seed)
+    centroids = points[rng.choice(len(points), n_clusters, replace=False)].copy()
+    point_sq_norms = (points ** 2).sum(axis=1, keepdims=True)
+    for _ in range(n_iter):
+        # ||p - c||^2 = ||p||^2 - 2 p.c + ||c||^2, so the cross term is one BLAS GEMM
+        # sharing the same (already multi-threaded) pool as the rest of the scoring
+        dists = point_sq_norms - 2.0 * (points @ centroids.T) + (centroids ** 2).sum(axis=1)
+        labels = np.argmin(dists, axis=1)
+        for k in range(n_clusters):
+            members = points[labels == k]
+            if len(members):  # Keep the previous centroid if a cluster empties out
+                centroids[k] = members.mean(axis=0)
+    return centroids
 
 
-# --- get_user_embeddings function remains the same ---
 def get_user_embeddings(user_track_ids, max_clusters=5):
     """Get cluster centroids for user's diverse tastes"""
-    valid_tracks = preprocessed_tracks[
-        preprocessed_tracks['track_id'].isin(user_track_ids)
-    ]
+    valid_row_idx = np.flatnonzero(preprocessed_tracks['track_id'].isin(user_track_ids).to_numpy())
+    valid_tracks = preprocessed_tracks.iloc[valid_row_idx]
 
     if valid_tracks.empty:
         return None, []
 
-    embeddings = valid_tracks[embedding_cols].values
+    embeddings = _ALL_EMB[valid_row_idx]
 
-    # Automatically determine cluster count (up to max_clusters)
-    n_clusters = min(max_clusters, len(embeddings))
-    if n_clusters > 1:
-        # Consider adding n_init='auto' for newer scikit-learn versions
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)  # Added n_init explicitly
-        clusters = kmeans.fit_predict(embeddings)
-        centroids = kmeans.cluster_centers_
+    # With no more tracks than clusters every track is its own cluster,
+    # so skip clustering entirely (sklearn's KMeans setup cost dominated here)
+    if len(embeddings) <= max_clusters:
+        centroids = embeddings
     else:
-        centroids = [np.mean(embeddings, axis=0)]
+        centroids = _lloyd_kmeans(embeddings, max_clusters)
 
     return centroids, valid_tracks['track_id'].tolist()
 
 
 # --- find_similar_tracks function MODIFIED ---
 def find_similar_tracks(user_centroids, n_per_cluster=500):
-    """Find similar tracks for each cluster centroid using sklearn.neighbors"""
-    all_results_indices = []
-
-    # Get the embeddings from the main dataset
-    all_embeddings = preprocessed_tracks[embedding_cols].values
-
-    # Initialize NearestNeighbors.
-    # 'cosine' is a good metric for embeddings (similar to Annoy's 'angular').
-    # 'n_jobs=-1' uses all available CPU cores for potentially faster fitting/querying.
-    # 'algorithm='auto'' lets sklearn choose the best algorithm (like BallTree for cosine).
-    nn_model = NearestNeighbors(
-        n_neighbors=n_per_cluster,
-        metric='cosine',
-        algorithm='auto',
-        n_jobs=-1
-    )
-
-    # Fit the model on all track embeddings
-    print("Fitting NearestNeighbors model...")
-    nn_model.fit(all_embeddings)
-    print("NearestNeighbors model fitted.")
-
-    # Search for neighbors for each centroid
+    """Find similar tracks for each cluster centroid using the HNSW _INDEX"""
+    # Normalise the centroids so the inner product against the unit-length
+    # track embeddings is the cosine similarity
     print(f"Querying neighbors for {len(user_centroids)} centroids...")
-    # kneighbors expects a 2D array of query points
-    distances, indices = nn_model.kneighbors(user_centroids)
+    centroids = _normalize_rows(user_centroids)
 
-    # indices is now a list of arrays, one per centroid. Flatten it.
-    all_results_indices = indices.flatten().tolist()
+    # faiss returns neighbours most similar first and pads with -1 when fewer are found.
+    # The search beam (efSearch) must be well above k for the top k to be accurate.
+    n_neighbors = min(n_per_cluster, _INDEX.ntotal)
+    search_params = faiss.SearchParametersHNSW(efSearch=2 * n_neighbors)
+    similarities, indices = _INDEX.search(centroids, n_neighbors, params=search_params)
+
+    # indices has one row per centroid (most similar first). Flatten it.
+    all_results_indices = indices[indices >= 0]
     print(f"Found {len(all_results_indices)} raw neighbor indices.")
 
-    # Deduplicate and limit the total number of results
-    # Using dict.fromkeys preserves order (in Python 3.7+) while deduplicating efficiently
-    unique_indices = list(dict.fromkeys(all_results_indices))[:1000]
+    # Deduplicate and limit the total number of results, keeping first-seen order,
+    # without boxing every index into a Python int
+    _, first_seen = np.unique(all_results_indices, return_index=True)
+    unique_indices = all_results_indices[np.sort(first_seen)][:1000]
     print(f"Returning {len(unique_indices)} unique track indices.")
 
     return preprocessed_tracks.iloc[unique_indices]
 
 # --- Helper Functions for Deduplication ---
 
+# Remove content within brackets/parentheses (like feat., with, etc.)
+_BRACKETED_RE = re.compile(r'\s*[\(\[].*?[\)\]]')
+# Remove common suffixes
+_SUFFIX_RE = re.compile(r'\s*-\s*(radio edit|remix|live|acoustic|version|edit|remastered.*|explicit.*|single version)')
+# Keep alphanumeric, spaces, and hyphens
+_PUNCTUATION_RE = re.compile(r'[^\w\s\-]')
+
 def normalize_name(name):
     """Lowercase, remove common parentheticals/suffixes, and punctuation."""
     if not isinstance(name, str):
         return "" # Handle non-string inputs
     name = name.lower()
-    # Remove content within brackets/parentheses (like feat., with, etc.)
-    name = re.sub(r'\s*[\(\[].*?[\)\]]', '', name).strip()
-    # Remove common suffixes
-    name = re.sub(r'\s*-\s*(radio edit|remix|live|acoustic|version|edit|remastered.*|explicit.*|single version)', '', name).strip()
+    name = _BRACKETED_RE.sub('', name).strip()
+    name = _SUFFIX_RE.sub('', name).strip()
     # Remove basic punctuation (optional, depending on how clean names are)
     # Keep alphanumeric and spaces, allows for names like 'Mr. Brightside'
-    name = re.sub(r'[^\w\s\-]', '', name) # Keep alphanumeric, spaces, and hyphens
+    name = _PUNCTUATION_RE.sub('', name)
     return name.strip()
 
 def get_artist_key(artists_string):
@@ -120,8 +211,110 @@ def get_artist_key(artists_string):
     return tuple(sorted(artist_list))
 
 
+# --- Precomputed deduplication keys ---
+# Track names and artists are static, so normalise them once at startup rather
+# than for every candidate on every request.
+preprocessed_tracks['_norm_name'] = preprocessed_tracks['track_name'].map(normalize_name)
+preprocessed_tracks['_artist_key'] = preprocessed_tracks['artists'].map(get_artist_key)
+# Integer ids for the keys so exact-duplicate detection can run in compiled code
+preprocessed_tracks['_artist_id'] = pd.factorize(preprocessed_tracks['_artist_key'])[0].astype(np.int32)
+preprocessed_tracks['_name_id'] = pd.factorize(preprocessed_tracks['_norm_name'])[0].astype(np.int32)
+_N_NAME_IDS = int(preprocessed_tracks['_name_id'].max()) + 1 if len(preprocessed_tracks) else 1
+
+
+@njit(cache=True)
+def _first_occurrence_mask(artist_ids, name_ids, n_name_ids):
+    """Flag the first candidate (in priority order) of each exact (artist, normalized name) pair"""
+    seen = Dict.empty(key_type=types.int64, value_type=types.boolean)
+    keep = np.zeros(len(artist_ids), dtype=np.bool_)
+    for i in range(len(artist_ids)):
+        pair = np.int64(artist_ids[i]) * n_name_ids + name_ids[i]
+        if pair not in seen:
+            seen[pair] = True
+            keep[i] = True
+    return keep
+
+
+def greedy_dedup(names, threshold):
+    """
+    Greedy near-duplicate removal over names given in priority order: a name is kept
+    unless it scores >= threshold (fuzz.ratio) against an earlier kept name.
+    Returns a boolean keep mask aligned with names.
+    """
+    # thefuzz rounded ratios to ints, so scores in [threshold - 0.5, threshold) counted
+    # as duplicates; rapidfuzz returns the raw float, so lower the cutoff to match
+    cutoff = threshold - 0.5
+    scores = process.cdist(list(names), list(names), scorer=fuzz.ratio, score_cutoff=cutoff, workers=1)
+    is_similar = np.triu(scores >= cutoff, k=1)  # Only later names can be duplicates of earlier ones
+    keep = np.ones(len(names), dtype=bool)
+    for i in range(len(names)):
+        if keep[i]:
+            keep[is_similar[i]] = False
+    return keep
+
+
 # --- Updated Mood Aware Filter Function ---
 
+@njit(cache=True)
+def _mood_filter_masks(feat_arr, lo, hi):
+    """
+    Evaluate every mood range filter in one pass over the (n_tracks, n_filters)
+    feature matrix. Returns the per-filter pass mask and, for each track, how many
+    leading filters it passes. NaN values compare False, so they fail the filter.
+    """
+    n_tracks, n_filters = feat_arr.shape
+    mask_cols = np.empty((n_tracks, n_filters), dtype=np.bool_)
+    deepest = np.zeros(n_tracks, dtype=np.int64)
+    for i in range(n_tracks):
+        passing_prefix = True
+        for j in range(n_filters):
+            value = feat_arr[i, j]
+            passed = value >= lo[j] and value <= hi[j]
+            mask_cols[i, j] = passed
+            passing_prefix = passing_prefix and passed
+            if passing_prefix:
+                deepest[i] += 1
+    return mask_cols, deepest
+
+
+def _top_k_positions(scores, k):
+    """Positions of the k highest scores, highest first, without sorting the rest"""
+    if k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def _deduplicate_candidates(tracks_df, candidate_pos, limit, threshold):
+    """
+    Deduplicate candidates given as row positions in priority order (same artist
+    key and near-identical normalized name). Returns the positions of up to
+    `limit` kept tracks, still in priority order.
+    """
+    # Fetch the precomputed dedup columns for the candidates as arrays, so no
+    # per-row Series is ever materialised
+    cand_norm_names = tracks_df['_norm_name'].to_numpy()[candidate_pos]
+    cand_artist_ids = tracks_df['_artist_id'].to_numpy(dtype=np.int32)[candidate_pos]
+    cand_name_ids = tracks_df['_name_id'].to_numpy(dtype=np.int32)[candidate_pos]
+
+    # Exact repeats of an earlier (artist, normalized name) pair are always
+    # duplicates, so drop them in one compiled pass before the fuzzy check.
+    # Only names not seen exactly before ever reach the Levenshtein comparison.
+    keep = _first_occurrence_mask(cand_artist_ids, cand_name_ids, _N_NAME_IDS)
+
+    # Duplicates are only ever looked for within the same artist key, so the greedy
+    # walk can run independently per artist group (in priority order within each
+    # group). Most artists contribute a single candidate and need no fuzzy work.
+    remaining = np.flatnonzero(keep)
+    by_artist = remaining[np.argsort(cand_artist_ids[remaining], kind='stable')]
+    group_starts = np.flatnonzero(np.diff(cand_artist_ids[by_artist])) + 1
+    for group in np.split(by_artist, group_starts):
+        if len(group) > 1:
+            keep[group] = greedy_dedup(cand_norm_names[group], threshold)
+
+    return candidate_pos[np.flatnonzero(keep)[:limit]]
+
+
 def mood_aware_filter(tracks_df: pd.DataFrame, mood_filters: dict, user_centroids: np.ndarray) -> pd.DataFrame:
     """
     Filters tracks based on mood criteria using a tiered fallback approach,
@@ -129,9 +322,10 @@ def mood_aware_filter(tracks_df: pd.DataFrame, mood_filters: dict, user_centroid
     based on similar track name and same artists (handles semicolon-separated artists).
 
     Args:
-        tracks_df: DataFrame of candidate tracks (e.g., 1000 similar tracks).
-                   Expected columns: 'track_name', 'artists', embedding columns ('emb_*'),
-                   and audio feature columns matching mood_filters keys.
+        tracks_df: DataFrame of candidate tracks (e.g., 1000 similar tracks), a subset of
+                   preprocessed_tracks whose index gives each row's position in _ALL_EMB.
+                   Expected columns: 'track_name', 'artists', and audio feature
+                   columns matching mood_filters keys.
         mood_filters: Dictionary for mood filtering {'feature': {'min': x, 'max': y}}.
         user_centroids: Numpy array of user cluster centroid embeddings.
 
@@ -153,15 +347,10 @@ def mood_aware_filter(tracks_df: pd.DataFrame, mood_filters: dict, user_centroid
 
     # --- Check for required columns ---
     required_cols = ['track_name', 'artists']
-    embedding_cols = [col for col in tracks_df.columns if col.startswith('emb_')]
-    if not embedding_cols:
-         print("Error: No embedding columns ('emb_*') found. Cannot calculate similarity.")
-         return pd.DataFrame(columns=tracks_df.columns) # Return empty DF
-    required_cols.extend(embedding_cols)
     if mood_filters:
         required_cols.extend(mood_filters.keys())
 
-    missing_cols = [col for col in required_cols if col not in tracks_df.columns and col not in embedding_cols] # Avoid double-counting embeddings
+    missing_cols = [col for col in required_cols if col not in tracks_df.columns]
     # Check specifically for track_name and artists needed for deduplication
     if 'track_name' not in tracks_df.columns or 'artists' not in tracks_df.columns:
         print("Error: Missing 'track_name' or 'artists' column required for deduplication.")
@@ -170,22 +359,25 @@ def mood_aware_filter(tracks_df: pd.DataFrame, mood_filters: dict, user_centroid
 
     # --- Calculate All Scores Upfront ---
     print("Calculating similarity scores for all candidate tracks...")
-    all_cluster_sims = np.array([
-        cosine_similarity(tracks_df[embedding_cols].values, [centroid]).flatten()
-        for centroid in user_centroids
-    ])
-    all_track_scores = np.max(all_cluster_sims, axis=0)
-    track_scores_series = pd.Series(all_track_scores, index=tracks_df.index)
+    # Slice the unit-length candidate embeddings out of _ALL_EMB_NORM once and
+    # score them against every normalised centroid with a single GEMM
+    cand_norm = _ALL_EMB_NORM[tracks_df.index.to_numpy()]
+    centroids_norm = _normalize_rows(user_centroids)
+    all_cluster_sims = cand_norm @ centroids_norm.T  # (n_cand, n_centroids) cosine similarities
+    all_track_scores = all_cluster_sims.max(axis=1)
     print("Similarity scores calculated.")
 
 
-    # --- Generate Prioritized Candidate List (potential_indices) ---
-    potential_indices = []
+    # --- Generate Candidate Priorities ---
+    # Each track's tier is the number of leading mood filters it passes (0 for all
+    # tracks when there are no usable filters). Candidates are prioritised by
+    # (tier desc, similarity desc): the strictest tier first, each tier sorted by
+    # similarity, with tracks passing no filter last.
+    deepest = np.zeros(len(tracks_df), dtype=np.int64)
 
     # Handle No Mood Filters Provided
     if not mood_filters:
         print("No mood filters provided. Will sort all candidates by similarity.")
-        potential_indices = track_scores_series.sort_values(ascending=False).index.tolist()
     else:
         # Apply Mood Filters Step-by-Step and Store Stages
         filter_order = list(mood_filters.keys())
@@ -193,110 +385,59 @@ def mood_aware_filter(tracks_df: pd.DataFrame, mood_filters: dict, user_centroid
 
         if not valid_filter_keys:
             print("Warning: None requested mood filter features found. Will sort all candidates by similarity.")
-            potential_indices = track_scores_series.sort_values(ascending=False).index.tolist()
         else:
             print(f"Applying filters in order: {valid_filter_keys}")
-            filter_stages = []
-            cumulative_mask = np.ones(len(tracks_df), dtype=bool)
-
+            active_filters = []  # (filter number, feature) for filters with a usable range
             for i, feature in enumerate(valid_filter_keys):
                 ranges = mood_filters[feature]
                 if 'min' not in ranges or 'max' not in ranges:
                      print(f"Warning: Skipping feature '{feature}' due to missing 'min' or 'max'.")
                      continue
-                min_range, max_range = ranges['min'], ranges['max']
-                feature_values = tracks_df[feature]
-                current_feature_mask = (feature_values >= min_range) & (feature_values <= max_range) & (~feature_values.isna())
-                cumulative_mask &= current_feature_mask
-                filter_stages.append((i + 1, feature, cumulative_mask.copy()))
-                print(f"--- Applied Filter {i+1}: {feature} ---")
-                print(f"  Tracks remaining after cumulative filter: {cumulative_mask.sum()}")
-
-            # Tiered Fallback Logic (to get initial candidate list)
-            added_indices_set_tiered = set()
-            print("\n--- Starting Tiered Selection (Pre-Deduplication) ---")
-            for i in range(len(filter_stages) - 1, -1, -1):
-                num_filters, feature_name, stage_mask = filter_stages[i]
-                current_stage_indices = set(tracks_df.index[stage_mask])
-                stricter_stage_indices = set(tracks_df.index[filter_stages[i+1][2]]) if i + 1 < len(filter_stages) else set()
-                newly_passed_indices = list(current_stage_indices - stricter_stage_indices)
-
-                if not newly_passed_indices: continue
-
-                # Sort newly passed indices within this tier by similarity
-                sorted_new_indices = track_scores_series.loc[newly_passed_indices].sort_values(ascending=False).index
-
-                for track_index in sorted_new_indices:
-                    if track_index not in added_indices_set_tiered:
-                        potential_indices.append(track_index)
-                        added_indices_set_tiered.add(track_index)
-                # print(f"Stage {num_filters} ({feature_name}): Added {len(newly_passed_indices)} unique candidates. Total potential: {len(potential_indices)}") # Can be verbose
-
-            # Add remaining top similarity tracks (those not caught by any filter stage)
-            print("\nAdding remaining tracks sorted by similarity (Pre-Deduplication)...")
-            all_sorted_indices_fallback = track_scores_series.sort_values(ascending=False).index
-            for track_index in all_sorted_indices_fallback:
-                 if track_index not in added_indices_set_tiered:
-                      potential_indices.append(track_index)
-                      # Keep track if needed, but potential_indices should now contain all tracks ordered
-                      # added_indices_set_tiered.add(track_index) # Not strictly necessary here if just appending
-
-    print(f"Total potential candidates before deduplication: {len(potential_indices)}")
+                active_filters.append((i + 1, feature))
+
+            # Pull the filtered features out of pandas once and build every
+            # per-feature mask as one (n_tracks, n_filters) boolean matrix.
+            # NaN feature values compare False, so they never pass a filter.
+            active_features = [feature for _, feature in active_filters]
+            feat_arr = np.ascontiguousarray(tracks_df[active_features].to_numpy(dtype=np.float32))
+            lo = np.array([mood_filters[f]['min'] for f in active_features], dtype=np.float32)
+            hi = np.array([mood_filters[f]['max'] for f in active_features], dtype=np.float32)
+            mask_cols, deepest = _mood_filter_masks(feat_arr, lo, hi)
+
+            # All counts come from single reductions: per-filter pass counts from a
+            # column sum, and cumulative counts from each track's tier (number of
+            # leading filters it passes). Tracks surviving filter j have tier >= j + 1.
+            feature_counts = mask_cols.sum(axis=0)
+            stage_counts = np.bincount(deepest, minlength=len(active_filters) + 1)[::-1].cumsum()[::-1][1:]
+
+            for j, (filter_num, feature) in enumerate(active_filters):
+                print(f"--- Applied Filter {filter_num}: {feature} ---")
+                print(f"  Tracks passing this filter alone: {feature_counts[j]}")
+                print(f"  Tracks remaining after cumulative filter: {stage_counts[j]}")
+
+    # Cosine scores lie in [-1, 1], so adding 3 per tier keeps every track of a
+    # higher tier ahead of every track of a lower one in a single scalar key
+    priority_key = deepest * 3.0 + all_track_scores
+    print(f"Total potential candidates before deduplication: {len(priority_key)}")
 
 
     # --- Deduplication Step ---
     print("\n--- Starting Deduplication ---")
-    final_deduplicated_indices = []
-    # Store details of songs already added to check against
-    # key = artist_key (tuple), value = list of (norm_name, index)
-    added_songs_by_artist = {}
-
-    processed_count = 0
-    # Iterate through the candidates in their priority order (mood tiers -> similarity)
-    for track_index in potential_indices:
-        processed_count += 1
-        if len(final_deduplicated_indices) >= FINAL_RECOMMENDATION_COUNT:
-            print(f"Reached target count ({FINAL_RECOMMENDATION_COUNT}) after processing {processed_count} candidates.")
-            break # Stop if we have enough unique recommendations
-
-        try:
-            # Get details for the current track using .loc for safety
-            track_details = tracks_df.loc[track_index]
-            current_name = track_details['track_name']
-            current_artists_str = track_details['artists'] # Raw artist string
-
-            # Normalize name and get canonical artist key
-            current_norm_name = normalize_name(current_name)
-            current_artist_key = get_artist_key(current_artists_str) # Uses the updated function
-
-            is_duplicate = False
-
-            # Check only against songs with the exact same artist key (tuple)
-            if current_artist_key in added_songs_by_artist:
-                for added_norm_name, added_index in added_songs_by_artist[current_artist_key]:
-                    # Compare normalized names using fuzzy matching
-                    similarity = fuzz.ratio(current_norm_name, added_norm_name)
-                    if similarity >= DEDUPLICATION_SIMILARITY_THRESHOLD:
-                        # Optional: Log the duplication found
-                        # print(f"  Duplicate Check: Index {track_index} ('{current_name}') vs Index {added_index} ('{added_norm_name}'). Artists: {current_artist_key}. Similarity: {similarity} >= {DEDUPLICATION_SIMILARITY_THRESHOLD}")
-                        is_duplicate = True
-                        break # Found a duplicate for this artist group, stop checking
-
-            # If it's not a duplicate, add its index to the final list
-            if not is_duplicate:
-                final_deduplicated_indices.append(track_index)
-
-                # Store its details (normalized name, index) under its artist key
-                if current_artist_key not in added_songs_by_artist:
-                    added_songs_by_artist[current_artist_key] = []
-                added_songs_by_artist[current_artist_key].append((current_norm_name, track_index))
-
-        except KeyError as e:
-             print(f"Warning: Skipping index {track_index}. Missing expected column: {e}")
-        except Exception as e:
-             # Log other potential errors during processing
-             print(f"Warning: Error processing index {track_index} ('{track_details.get('track_name', 'N/A')}', Artists: '{track_details.get('artists', 'N/A')}'): {type(e).__name__} - {e}")
-
+    # Only the top of the priority order is needed, so select a pool of the best
+    # candidates without sorting all of them. If duplicates leave too few tracks
+    # in the pool, fall back to the full priority order.
+    pool_size = 2 * FINAL_RECOMMENDATION_COUNT
+    while True:
+        candidate_pos = _top_k_positions(priority_key, pool_size)
+        kept_pos = _deduplicate_candidates(
+            tracks_df, candidate_pos, FINAL_RECOMMENDATION_COUNT, DEDUPLICATION_SIMILARITY_THRESHOLD
+        )
+        if len(kept_pos) >= FINAL_RECOMMENDATION_COUNT or pool_size >= len(priority_key):
+            break
+        print(f"Only {len(kept_pos)} unique tracks in the top {pool_size} candidates. Using all candidates.")
+        pool_size = len(priority_key)
+
+    final_deduplicated_indices = tracks_df.index[kept_pos].tolist()
 
     print(f"--- Final Deduplicated Recommendation Count: {len(final_deduplicated_indices)} ---")
 
@@ -384,5 +525,7 @@ def recommend():
 
 
 if __name__ == '__main__':
+    # Single-threaded development server only. In production run
+    # `gunicorn content_based_service:app` from this directory (see gunicorn.conf.py)
     # Consider adding debug=True for development, but remove for production
     app.run(host='0.0.0.0', port=5173)  # , debug=True)
@@ -0,0 +1,24 @@
+# Gunicorn settings for the content-based recommendation service.
+# Run from this directory with:  gunicorn content_based_service:app
+import os
+import multiprocessing
+
+# BLAS/OpenMP read these when numpy/faiss are first imported, so they must be set
+# here, before the app is preloaded. Each worker gets one 4-thread pool instead of
+# every worker spinning up one thread per core.
+for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(var, '4')
+
+bind = '0.0.0.0:5173'
+workers = max(1, multiprocessing.cpu_count() // 4)  # One worker per 4 BLAS threads
+threads = 1
+
+# Load the parquet, embedding matrices and HNSW index once in the master so the
+# forked workers share them copy-on-write instead of each loading their own.
+# Anything the master runs before forking must stay out of OpenMP parallel
+# regions (libgomp is not fork-safe), which is why the service builds a missing
+# HNSW index single-threaded.
+preload_app = True
+
+# Requests do a few hundred ms of CPU work; leave headroom above that.
+timeout = 60